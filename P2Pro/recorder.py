@@ -1,46 +1,194 @@
 import platform
 import threading
 import queue
-import time
 import sounddevice as sd
-import wave
 import os
 import subprocess
 import logging
+import functools
 
 import numpy as np
 import ffmpeg
 
 import P2Pro.util as util
 
+if platform.system() == 'Linux':
+    import fcntl
+
 log = logging.getLogger(__name__)
 
+# one RGB frame is ~295 KB, make sure a whole frame fits into the pipe in one go
+FFMPEG_PIPE_BUFSIZE = 1 << 20
 
-class AudioRecorder:
-    def __init__(self, path):
-        self.WAVE_OUTPUT_FILENAME = path + '.wav'
-        self.CHUNK = 1024  # Number of frames per buffer
-        self.FORMAT = 'int16'  # SoundDevice uses string format
-        self.RATE = 44100
-
-        # Set number of channels based on platform
-        if platform.system() == "Darwin":
-            self.CHANNELS = 1
-        else:
-            self.CHANNELS = 2
+# Passing extra pipes to ffmpeg (pass_fds) is not possible on Windows, there the streams are recorded to temp files and merged afterwards
+FUSED_MUX = platform.system() != 'Windows'
+
+
+def _enlarge_pipe(fd: int):
+    if platform.system() == 'Linux':
+        # the kernel pipe buffer (64 KB by default) is the actual limit, grow it as well
+        try:
+            fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), FFMPEG_PIPE_BUFSIZE)
+        except OSError:
+            log.debug("Could not enlarge ffmpeg pipe buffer")
+
+
+# no lookahead, so frames get encoded as soon as they are written and stdin doesn't back up
+X264_CODEC_ARGS = {'c': 'libx264', 'pix_fmt': 'yuv420p', 'crf': '16', 'preset': 'ultrafast', 'tune': 'zerolatency', 'threads': 2,
+                   'x264-params': 'sliced-threads=1:sync-lookahead=0:rc-lookahead=0'}
+
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+# hardware H.264 encoders to try per platform, as (output args, global args)
+HW_H264_CODECS = {
+    'Darwin': [
+        ({'c': 'h264_videotoolbox', 'pix_fmt': 'yuv420p', 'allow_sw': 1, 'realtime': 1, 'b': '4M'}, []),
+    ],
+    'Linux': [
+        ({'c': 'h264_vaapi', 'filter': 'format=nv12,hwupload', 'qp': 16}, ['-vaapi_device', VAAPI_DEVICE]),
+        ({'c': 'h264_nvenc', 'pix_fmt': 'yuv420p', 'preset': 'p1', 'tune': 'ull', 'rc': 'constqp', 'qp': 16}, []),
+    ],
+    'Windows': [
+        ({'c': 'h264_nvenc', 'pix_fmt': 'yuv420p', 'preset': 'p1', 'tune': 'ull', 'rc': 'constqp', 'qp': 16}, []),
+    ],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _pick_h264_codec():
+    """
+    Returns (output args, global args) for the first hardware H.264 encoder that works on this machine, falling back to libx264.
+    Each candidate is probed by encoding a few test frames, as ffmpeg builds often include encoders for hardware that isn't there.
+    """
+    for codec_args, global_args in HW_H264_CODECS.get(platform.system(), []):
+        if codec_args['c'] == 'h264_vaapi' and not os.path.exists(VAAPI_DEVICE):
+            continue
+        try:
+            (
+                ffmpeg
+                .input('color=size=256x192:rate=25', format='lavfi')
+                .output('-', format='null', vframes=5, **codec_args)
+                .global_args(*global_args)
+                .run(capture_stdout=True, capture_stderr=True)
+            )
+        except (ffmpeg.Error, OSError):
+            log.debug(f"H.264 encoder {codec_args['c']} not usable")
+            continue
+        log.info(f"Using hardware H.264 encoder {codec_args['c']}")
+        return codec_args, global_args
+    return X264_CODEC_ARGS, []
+
+
+_h264_probe_lock = threading.Lock()
+_h264_probe_thread = None
+
+
+def _start_h264_codec_probe():
+    """
+    Starts probing the H.264 encoders in the background, once per process.
+    """
+    global _h264_probe_thread
+    with _h264_probe_lock:
+        if _h264_probe_thread is None:
+            _h264_probe_thread = threading.Thread(target=_pick_h264_codec, daemon=True)
+            _h264_probe_thread.start()
+
+
+def _h264_codec():
+    """
+    Waits for the background probe and returns its result, see _pick_h264_codec().
+    """
+    _start_h264_codec_probe()
+    _h264_probe_thread.join()
+    return _pick_h264_codec()
+
+
+def _audio_input_available() -> bool:
+    try:
+        sd.query_devices(kind='input')
+    except (sd.PortAudioError, ValueError):
+        return False
+    return True
+
+
+def _close_pipe(pipe):
+    try:
+        pipe.close()
+    except OSError:
+        pass  # ffmpeg is already gone, nothing left to flush to
+
+
+def _popen_ffmpeg(stream, pass_fds=()) -> subprocess.Popen:
+    """
+    Like ffmpeg-python's run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True), but with an enlarged stdin buffer.
+    """
+    proc = subprocess.Popen(ffmpeg.compile(stream), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            bufsize=FFMPEG_PIPE_BUFSIZE, pass_fds=pass_fds)
+    _enlarge_pipe(proc.stdin.fileno())
+    return proc
+
+
+class PipeWriter:
+    """
+    Writes buffers to a pipe from its own thread. The caller only blocks once maxsize buffers are waiting, not on a
+    pipe that ffmpeg isn't reading yet (e.g. while it is still opening another input).
+    """
+
+    def __init__(self, pipe, maxsize: int = 8):
+        self.pipe = pipe
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._write_out)
+        self._thread.start()
+
+    def write(self, data):
+        self._queue.put(data)
+
+    def close(self):
+        # writes everything still queued, then closes the pipe
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_out(self):
+        broken = False
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if broken:
+                continue  # keep draining, so write() never blocks on a dead pipe
+            try:
+                self.pipe.write(data)
+                # each buffer is passed on right away, ffmpeg timestamps the frames when it reads them
+                self.pipe.flush()
+            except OSError:
+                log.error("ffmpeg stopped accepting data, discarding the rest")
+                broken = True
+        _close_pipe(self.pipe)
 
-        # Prepare to write to the .wav file
-        self.wf = wave.open(self.WAVE_OUTPUT_FILENAME, 'wb')
-        self.wf.setnchannels(self.CHANNELS)
-        self.wf.setsampwidth(2)  # 2 bytes for 'int16'
-        self.wf.setframerate(self.RATE)
+
+class AudioRecorder:
+    CHUNK = 1024  # Number of frames per buffer
+    FORMAT = 'int16'  # SoundDevice uses string format
+    RATE = 44100
+    # Set number of channels based on platform
+    CHANNELS = 1 if platform.system() == "Darwin" else 2
+
+    def __init__(self, pipe):
+        """
+        Streams raw interleaved s16le samples into the binary file object pipe, usually the input of an ffmpeg process.
+        """
+        self.pipe = pipe
 
         self.recording = False
         self.thread = None
-        self.frames = []  # Buffer for storing the audio data
+        self.writer_thread = None
+        self._chunk_queue = queue.Queue()  # Raw int16 chunks waiting to be written out
 
     def start(self):
         self.recording = True
+        # Start the writer thread, it drains the queue until it gets the None sentinel and then closes the pipe
+        self.writer_thread = threading.Thread(target=self._write_out)
+        self.writer_thread.start()
         # Start the recording thread
         t = threading.Thread(target=self.record)
         t.start()
@@ -48,31 +196,46 @@ class AudioRecorder:
 
     def stop(self):
         self.recording = False
+        # the recording thread signals end of stream to the writer, wait for the remaining chunks to be flushed
         self.thread.join()
-
-        # Write all buffered frames to the wave file
-        self._write_to_wavefile()
-
-        self.wf.close()
+        self.writer_thread.join()
 
     def record(self):
         # Callback function to handle audio chunks
         def callback(indata, frames, time, status):
             if status:
                 print(f"Status: {status}")
-            # Append the recorded frames to the buffer
-            self.frames.append(indata.copy())
-
-        # Open the input stream with the specified format and channels
-        with sd.InputStream(samplerate=self.RATE, channels=self.CHANNELS,
-                            dtype=self.FORMAT, blocksize=self.CHUNK, callback=callback):
-            while self.recording:
-                sd.sleep(100)  # Sleep while the callback processes data
+            # Hand the chunk to the writer thread, indata is already contiguous int16
+            self._chunk_queue.put(bytes(indata))
 
-    def _write_to_wavefile(self):
-        # Convert the frames to a single NumPy array and write to the wave file
-        audio_data = np.concatenate(self.frames, axis=0)
-        self.wf.writeframes(audio_data.astype(np.int16).tobytes())
+        try:
+            # Open the input stream with the specified format and channels
+            with sd.InputStream(samplerate=self.RATE, channels=self.CHANNELS,
+                                dtype=self.FORMAT, blocksize=self.CHUNK, callback=callback):
+                while self.recording:
+                    sd.sleep(100)  # Sleep while the callback processes data
+        except sd.PortAudioError as e:
+            log.error(f"Audio recording failed: {e}")
+        finally:
+            # always end the stream, otherwise ffmpeg keeps waiting for audio data
+            self._chunk_queue.put(None)
+
+    def _write_out(self):
+        # Stream chunks out as they arrive, so nothing piles up in memory
+        # (and the sounddevice callback never blocks on a full pipe)
+        broken = False
+        while True:
+            chunk = self._chunk_queue.get()
+            if chunk is None:
+                break
+            if broken:
+                continue  # keep draining the queue until the recording thread is done
+            try:
+                self.pipe.write(chunk)
+            except OSError:
+                log.error("ffmpeg stopped accepting audio data, discarding the rest")
+                broken = True
+        _close_pipe(self.pipe)
 
 
 class VideoRecorder:
@@ -85,81 +248,147 @@ class VideoRecorder:
         self.with_radiometry = radiometry
         self.with_audio = audio
 
+        # private stop marker, so a token left in the shared queue can't end another recorder's recording
+        self._stop_token = object()
+
+        # probe the encoders while nothing is waiting on them yet, the result is cached for later recordings
+        _start_h264_codec_probe()
+
     def capture_still(self, path: str):
         # R-JPEG?
         pass
 
-    def rec_thread(self):
-        while self.input_queue.empty():
-            time.sleep(0.01)
-            pass
-
-        # TODO: metadata
-
-        frame = self.input_queue.queue[0]  # peek first element in queue
-        rgb_resolution = frame['rgb_data'].shape
-        therm_resolution = frame['thermal_data'].shape
+    def _next_frame(self):
+        """
+        Blocks until the next frame arrives. Returns None once recording was stopped.
+        """
+        while self.rec_running:
+            try:
+                # the timeout only guards against the stop token being discarded by the producer
+                item = self.input_queue.get(True, 1)
+            except queue.Empty:
+                continue
+            if item is self._stop_token:
+                return None
+            if isinstance(item, dict):
+                return item
+            # anything else is a stale stop token of a previous recorder
+        return None
+
+    @staticmethod
+    def _rgb_input(rgb_resolution, filename='pipe:'):
+        # the pseudo color image is passed on as the camera delivers it, ffmpeg's swscale takes care of the conversion
+        return ffmpeg.input(filename, format='rawvideo', pix_fmt='yuyv422', s=f'{rgb_resolution[1]}x{rgb_resolution[0]}',
+                            use_wallclock_as_timestamps='1', fflags='nobuffer')
+
+    @staticmethod
+    def _therm_input(therm_resolution, filename='pipe:'):
+        return ffmpeg.input(filename, format='rawvideo', pix_fmt='gray16le', s=f'{therm_resolution[1]}x{therm_resolution[0]}',
+                            use_wallclock_as_timestamps='1')
+
+    @staticmethod
+    def _audio_input(filename='pipe:'):
+        return ffmpeg.input(filename, format='s16le', ar=AudioRecorder.RATE, ac=AudioRecorder.CHANNELS)
+
+    # FFV1 version 3 allows for multiple slices, which are encoded in parallel
+    therm_codec_args = {'c': 'ffv1', 'level': 3, 'threads': 0, 'slices': 4, 'slicecrc': 0, 'context': 1}
+
+    def _start_fused(self, rgb_resolution, therm_resolution):
+        """
+        Starts a single ffmpeg process that encodes and muxes all streams straight into the final file.
+        rgb is fed through stdin, thermal and audio data through extra pipes.
+        """
+        rgb_codec_args, global_args = _h264_codec()
+        in_streams = [self._rgb_input(rgb_resolution)]
+        out_args = {f'{k}:v:0': v for k, v in rgb_codec_args.items()}
+        child_fds = []
+
+        therm_pipe = None
+        if self.with_radiometry:
+            read_fd, write_fd = os.pipe()
+            _enlarge_pipe(write_fd)
+            child_fds.append(read_fd)
+            # ffmpeg opens its inputs one after another, writing this from the frame loop could block before ffmpeg
+            # gets to reading stdin (the pipe can't be enlarged on macOS)
+            therm_pipe = PipeWriter(os.fdopen(write_fd, 'wb', buffering=FFMPEG_PIPE_BUFSIZE))
+            in_streams.append(self._therm_input(therm_resolution, f'pipe:{read_fd}'))
+            out_args.update({f'{k}:v:1': v for k, v in self.therm_codec_args.items()})
+
+        audio = None
+        if self.with_audio:
+            read_fd, write_fd = os.pipe()
+            child_fds.append(read_fd)
+            audio = AudioRecorder(pipe=os.fdopen(write_fd, 'wb'))
+            in_streams.append(self._audio_input(f'pipe:{read_fd}'))
+            out_args['c:a'] = 'aac'
 
-        proc_rgb: subprocess.Popen = (
+        proc = _popen_ffmpeg(
             ffmpeg
-            .input('pipe:', format='rawvideo', pix_fmt='rgb24', s=f'{rgb_resolution[1]}x{rgb_resolution[0]}', use_wallclock_as_timestamps='1')
-            .output(self.path + '.rgb.mkv', vcodec='libx264', crf='16')
-            .overwrite_output()
-            .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+            .output(*in_streams, self.path + '.mkv', map_metadata=-1, flush_packets='1', **out_args)
+            .global_args(*global_args)
+            .overwrite_output(),
+            pass_fds=child_fds
         )
-        util.PipeLogger(proc_rgb.stdout, log.debug)
-        util.PipeLogger(proc_rgb.stderr, log.debug)
+        # the read ends belong to ffmpeg now
+        for fd in child_fds:
+            os.close(fd)
+
+        return [proc], proc.stdin, therm_pipe, audio
+
+    def _start_separate(self, rgb_resolution, therm_resolution):
+        """
+        Starts one ffmpeg process per stream, each writing to its own temp file.
+        """
+        rgb_codec_args, global_args = _h264_codec()
+        procs = [_popen_ffmpeg(
+            self._rgb_input(rgb_resolution)
+            .output(self.path + '.rgb.mkv', flush_packets='1', **rgb_codec_args)
+            .global_args(*global_args)
+            .overwrite_output()
+        )]
+        rgb_pipe = procs[0].stdin
 
+        therm_pipe = None
         if self.with_radiometry:
-            proc_therm: subprocess.Popen = (
-                ffmpeg
-                .input('pipe:', format='rawvideo', pix_fmt='gray16le', s=f'{therm_resolution[1]}x{therm_resolution[0]}', use_wallclock_as_timestamps='1')
-                .output(self.path + '.therm.mkv', vcodec='ffv1')
+            procs.append(_popen_ffmpeg(
+                self._therm_input(therm_resolution)
+                .output(self.path + '.therm.mkv', **self.therm_codec_args)
                 .overwrite_output()
-                .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
-            )
-            util.PipeLogger(proc_therm.stdout, log.debug)
-            util.PipeLogger(proc_therm.stderr, log.debug)
+            ))
+            therm_pipe = PipeWriter(procs[1].stdin)
 
+        audio = None
         if self.with_audio:
-            proc_audio = AudioRecorder(self.path)
-            proc_audio.start()
-
-        while self.rec_running:
-            try:
-                frame = self.input_queue.get(True, 0.1)
-            except queue.Empty:
-                continue
-
-            proc_rgb.stdin.write(frame['rgb_data'].astype(np.uint8).tobytes())
-            if self.with_radiometry:
-                proc_therm.stdin.write(frame['thermal_data'].astype(np.uint16).tobytes())
-
-        if self.with_audio:
-            proc_audio.stop()
-
-        proc_rgb.stdin.close()
-        proc_rgb.wait()
+            # encode to AAC right away, so the merge is a plain stream copy and the temp file stays small
+            procs.append(_popen_ffmpeg(
+                self._audio_input()
+                .output(self.path + '.audio.mka', c='aac')
+                .overwrite_output()
+            ))
+            audio = AudioRecorder(procs[-1].stdin)
 
-        if self.with_radiometry:
-            proc_therm.stdin.close()
-            proc_therm.wait()
+        return procs, rgb_pipe, therm_pipe, audio
 
-        # merge files
+    def _merge_temp_files(self):
         in_streams = [ffmpeg.input(self.path + '.rgb.mkv')]
         if self.with_radiometry:
             in_streams.append(ffmpeg.input(self.path + '.therm.mkv'))
         if self.with_audio:
-            in_streams.append(ffmpeg.input(self.path + '.wav'))
+            in_streams.append(ffmpeg.input(self.path + '.audio.mka'))
 
+        # all streams are already encoded, this only remuxes them
         out = ffmpeg.output(
             *in_streams,
             self.path + '.mkv',
-            vcodec='copy',
-            acodec='aac',
+            c='copy',
             map_metadata=-1,
         )
-        ret, err = out.run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
+        try:
+            ret, err = out.run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
+        except ffmpeg.Error as e:
+            log.error(f"Failed to merge temporary recording files, they are kept at {self.path}.*")
+            log.debug(e.stderr.decode('utf-8'))
+            return
         log.debug(ret.decode('utf-8'))
         log.debug(err.decode('utf-8'))
 
@@ -168,18 +397,105 @@ class VideoRecorder:
             if self.with_radiometry:
                 os.remove(self.path + '.therm.mkv')
             if self.with_audio:
-                os.remove(self.path + '.wav')
+                os.remove(self.path + '.audio.mka')
         except FileNotFoundError:
             log.warn("Failed to remove one or more temporary recording files")
 
+    def rec_thread(self):
+        frame = self._next_frame()
+        if frame is None:
+            return
+
+        # TODO: metadata
+
+        rgb_resolution = frame['yuv_data'].shape
+        therm_resolution = frame['thermal_data'].shape
+
+        # frames are written to ffmpeg straight from their buffers, so they have to match the input pix_fmt exactly
+        if frame['yuv_data'].dtype != np.uint8 or not frame['yuv_data'].flags['C_CONTIGUOUS']:
+            raise TypeError("yuv_data must be a C-contiguous uint8 array")
+        if frame['thermal_data'].dtype != np.uint16 or not frame['thermal_data'].flags['C_CONTIGUOUS']:
+            raise TypeError("thermal_data must be a C-contiguous uint16 array")
+
+        if self.with_audio and not _audio_input_available():
+            log.warning("No audio input device found, recording without audio")
+            self.with_audio = False
+
+        if FUSED_MUX:
+            procs, rgb_pipe, therm_pipe, audio = self._start_fused(rgb_resolution, therm_resolution)
+        else:
+            procs, rgb_pipe, therm_pipe, audio = self._start_separate(rgb_resolution, therm_resolution)
+
+        for proc in procs:
+            util.PipeLogger(proc.stdout, log.debug)
+            util.PipeLogger(proc.stderr, log.debug)
+
+        if audio is not None:
+            audio.start()
+
+        try:
+            self._write_frames(frame, rgb_pipe, therm_pipe)
+        except OSError:
+            # BrokenPipeError on POSIX, on Windows writing to a dead process' stdin usually fails with EINVAL instead
+            log.error("ffmpeg stopped accepting frames, see debug log for its output")
+        finally:
+            # stops the sounddevice thread, which would otherwise keep running after an error
+            if audio is not None:
+                audio.stop()
+
+        _close_pipe(rgb_pipe)
+        if therm_pipe is not None:
+            therm_pipe.close()
+
+        for proc in procs:
+            proc.wait()
+
+        if not FUSED_MUX:
+            self._merge_temp_files()
+
         log.info(f"Recording finished.")
 
+    def _write_frames(self, frame, rgb_pipe, therm_pipe):
+        while frame is not None:
+            # written via the buffer protocol, no intermediate bytes objects. The capture backends never reuse a frame's
+            # memory while it is still referenced, so there is no need to copy it into a buffer owned by the recorder.
+            rgb_pipe.write(frame['yuv_data'].data)
+            if therm_pipe is not None:
+                # thermal_data is a uint16 view of the captured frame's bytes, so this already passes on the raw sensor
+                # data as is. No separate bytes entry in the frame is needed for that.
+                therm_pipe.write(frame['thermal_data'].data)
+
+            # ffmpeg timestamps the frames when it reads them (use_wallclock_as_timestamps), so they must not sit in the
+            # pipe buffers until several frames have piled up. With the enlarged pipes each frame is a single write.
+            # (the thermal PipeWriter flushes on its own)
+            rgb_pipe.flush()
+
+            frame = self._next_frame()
+
     def start(self):
         log.info(f"Starting video recording to file {self.path + '.mkv'} ...")
+        # drop frames (and stop tokens) that piled up before, the recording starts with the next captured frame
+        while True:
+            try:
+                self.input_queue.get_nowait()
+            except queue.Empty:
+                break
         self.rec_running = True
         self.rec_thread = threading.Thread(target=self.rec_thread)
         self.rec_thread.start()
 
     def stop(self):
         self.rec_running = False
-        log.info(f"Stopping video recording, merging temp files...")
+        # wake up the recorder thread, discarding a pending frame if the queue is full
+        try:
+            self.input_queue.put_nowait(self._stop_token)
+        except queue.Full:
+            try:
+                self.input_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.input_queue.put_nowait(self._stop_token)
+            except queue.Full:
+                pass  # the producer refilled the queue in between, the get() timeout ends the recording instead
+        log.info(f"Stopping video recording...")
@@ -0,0 +1,273 @@
+import os
+import mmap
+import fcntl
+import ctypes
+import logging
+
+import cv2
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Minimal subset of the V4L2 API (linux/videodev2.h), just enough to stream raw YUYV frames via MMAP buffers
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_NONE = 1
+
+
+def _fourcc(a, b, c, d):
+    return ord(a) | (ord(b) << 8) | (ord(c) << 16) | (ord(d) << 24)
+
+
+V4L2_PIX_FMT_YUYV = _fourcc('Y', 'U', 'Y', 'V')
+
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_uint32),
+        ('height', ctypes.c_uint32),
+        ('pixelformat', ctypes.c_uint32),
+        ('field', ctypes.c_uint32),
+        ('bytesperline', ctypes.c_uint32),
+        ('sizeimage', ctypes.c_uint32),
+        ('colorspace', ctypes.c_uint32),
+        ('priv', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('ycbcr_enc', ctypes.c_uint32),
+        ('quantization', ctypes.c_uint32),
+        ('xfer_func', ctypes.c_uint32),
+    ]
+
+
+class _v4l2_format_union(ctypes.Union):
+    _fields_ = [
+        ('pix', v4l2_pix_format),
+        ('raw_data', ctypes.c_uint8 * 200),
+        ('_align', ctypes.c_void_p),  # the kernel union contains pointers (struct v4l2_window)
+    ]
+
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('fmt', _v4l2_format_union),
+    ]
+
+
+class v4l2_fract(ctypes.Structure):
+    _fields_ = [
+        ('numerator', ctypes.c_uint32),
+        ('denominator', ctypes.c_uint32),
+    ]
+
+
+class v4l2_captureparm(ctypes.Structure):
+    _fields_ = [
+        ('capability', ctypes.c_uint32),
+        ('capturemode', ctypes.c_uint32),
+        ('timeperframe', v4l2_fract),
+        ('extendedmode', ctypes.c_uint32),
+        ('readbuffers', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 4),
+    ]
+
+
+class _v4l2_streamparm_union(ctypes.Union):
+    _fields_ = [
+        ('capture', v4l2_captureparm),
+        ('raw_data', ctypes.c_uint8 * 200),
+    ]
+
+
+class v4l2_streamparm(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('parm', _v4l2_streamparm_union),
+    ]
+
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [
+        ('count', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('flags', ctypes.c_uint8),
+        ('reserved', ctypes.c_uint8 * 3),
+    ]
+
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('frames', ctypes.c_uint8),
+        ('seconds', ctypes.c_uint8),
+        ('minutes', ctypes.c_uint8),
+        ('hours', ctypes.c_uint8),
+        ('userbits', ctypes.c_uint8 * 4),
+    ]
+
+
+class _v4l2_buffer_m(ctypes.Union):
+    _fields_ = [
+        ('offset', ctypes.c_uint32),
+        ('userptr', ctypes.c_ulong),
+        ('planes', ctypes.c_void_p),
+        ('fd', ctypes.c_int32),
+    ]
+
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [
+        ('index', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('bytesused', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('field', ctypes.c_uint32),
+        ('timestamp', ctypes.c_long * 2),  # struct timeval
+        ('timecode', v4l2_timecode),
+        ('sequence', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('m', _v4l2_buffer_m),
+        ('length', ctypes.c_uint32),
+        ('reserved2', ctypes.c_uint32),
+        ('request_fd', ctypes.c_int32),
+    ]
+
+
+def _IOC(direction, nr, struct_type):
+    return (direction << 30) | (ctypes.sizeof(struct_type) << 16) | (ord('V') << 8) | nr
+
+
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+VIDIOC_S_FMT = _IOC(_IOC_READ | _IOC_WRITE, 5, v4l2_format)
+VIDIOC_REQBUFS = _IOC(_IOC_READ | _IOC_WRITE, 8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _IOC(_IOC_READ | _IOC_WRITE, 9, v4l2_buffer)
+VIDIOC_QBUF = _IOC(_IOC_READ | _IOC_WRITE, 15, v4l2_buffer)
+VIDIOC_DQBUF = _IOC(_IOC_READ | _IOC_WRITE, 17, v4l2_buffer)
+VIDIOC_STREAMON = _IOC(_IOC_WRITE, 18, ctypes.c_int)
+VIDIOC_STREAMOFF = _IOC(_IOC_WRITE, 19, ctypes.c_int)
+VIDIOC_G_PARM = _IOC(_IOC_READ | _IOC_WRITE, 21, v4l2_streamparm)
+
+
+class V4L2Capture:
+    """
+    Captures raw YUYV frames straight from a V4L2 device using MMAP streaming I/O.
+    Mimics the parts of cv2.VideoCapture used by Video.open, with RGB conversion always turned off.
+    Not thread safe, read() and release() have to be called from the same thread.
+    """
+
+    def __init__(self, device, width, height, num_buffers=4):
+        if isinstance(device, int):
+            device = f'/dev/video{device}'
+
+        self.fd = None
+        self.buffers = []
+        self.width = width
+        self.height = height
+        self.framerate = 0.0
+
+        try:
+            self._open(device, num_buffers)
+        except OSError as e:
+            log.error(f"Could not open V4L2 device {device}: {e}")
+            self.release()
+
+    def _open(self, device, num_buffers):
+        self.fd = os.open(device, os.O_RDWR)
+
+        fmt = v4l2_format(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        fmt.fmt.pix.width = self.width
+        fmt.fmt.pix.height = self.height
+        fmt.fmt.pix.pixelformat = V4L2_PIX_FMT_YUYV
+        fmt.fmt.pix.field = V4L2_FIELD_NONE
+        fcntl.ioctl(self.fd, VIDIOC_S_FMT, fmt)
+        # the driver adjusts the format to what it actually supports
+        self.width = fmt.fmt.pix.width
+        self.height = fmt.fmt.pix.height
+        self.frame_size = self.width * self.height * 2
+
+        # not every driver supports this, the framerate then stays unknown (0, like OpenCV reports it)
+        parm = v4l2_streamparm(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        try:
+            fcntl.ioctl(self.fd, VIDIOC_G_PARM, parm)
+        except OSError:
+            log.debug("VIDIOC_G_PARM not supported, framerate unknown")
+        else:
+            timeperframe = parm.parm.capture.timeperframe
+            if timeperframe.numerator:
+                self.framerate = timeperframe.denominator / timeperframe.numerator
+
+        req = v4l2_requestbuffers(count=num_buffers, type=V4L2_BUF_TYPE_VIDEO_CAPTURE, memory=V4L2_MEMORY_MMAP)
+        fcntl.ioctl(self.fd, VIDIOC_REQBUFS, req)
+
+        for i in range(req.count):
+            buf = v4l2_buffer(index=i, type=V4L2_BUF_TYPE_VIDEO_CAPTURE, memory=V4L2_MEMORY_MMAP)
+            fcntl.ioctl(self.fd, VIDIOC_QUERYBUF, buf)
+            self.buffers.append(mmap.mmap(self.fd, buf.length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE,
+                                          offset=buf.m.offset))
+            fcntl.ioctl(self.fd, VIDIOC_QBUF, buf)
+
+        fcntl.ioctl(self.fd, VIDIOC_STREAMON, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+
+    def isOpened(self):
+        return self.fd is not None
+
+    def read(self):
+        if not self.isOpened():
+            return False, None
+
+        buf = v4l2_buffer(type=V4L2_BUF_TYPE_VIDEO_CAPTURE, memory=V4L2_MEMORY_MMAP)
+        try:
+            fcntl.ioctl(self.fd, VIDIOC_DQBUF, buf)
+        except OSError:
+            return False, None
+
+        try:
+            if buf.bytesused < self.frame_size:
+                return False, None
+            # Frames are handed on to other threads and outlive the driver buffer, so this is the single copy out of
+            # the mmap'd buffer before it gets re-queued. OpenCV needs at least the same copy.
+            frame = np.frombuffer(self.buffers[buf.index], np.uint8, count=self.frame_size).reshape((self.height, self.width, 2)).copy()
+        finally:
+            fcntl.ioctl(self.fd, VIDIOC_QBUF, buf)
+
+        return True, frame
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            fcntl.ioctl(self.fd, VIDIOC_STREAMOFF, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        except OSError:
+            pass
+        for buffer in self.buffers:
+            buffer.close()
+        self.buffers = []
+        os.close(self.fd)
+        self.fd = None
+
+    def get(self, prop_id):
+        """
+        Mimics VideoCapture::get behavior for width, height, and fps.
+        """
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        elif prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        elif prop_id == cv2.CAP_PROP_FPS:
+            return self.framerate
+        else:
+            return None
+
+    def set(self, prop_id, value):
+        """
+        Mimics VideoCapture::set behavior for CAP_PROP_CONVERT_RGB, frames are always delivered as raw YUYV.
+        """
+        if prop_id == cv2.CAP_PROP_CONVERT_RGB:
+            return value == 0
+        return False
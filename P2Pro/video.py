@@ -1,9 +1,11 @@
 import platform
 import time
+import threading
 import queue
 import logging
 import subprocess
 import re
+import sys
 from typing import Union
 
 import P2Pro.P2Pro_cmd as P2Pro_CMD
@@ -11,8 +13,13 @@ import P2Pro.P2Pro_cmd as P2Pro_CMD
 import cv2
 import numpy as np
 
-if platform.system() == 'Linux':
+IS_WINDOWS = platform.system() == 'Windows'
+IS_DARWIN = platform.system() == 'Darwin'
+IS_LINUX = platform.system() == 'Linux'
+
+if IS_LINUX:
     import pyudev
+    import P2Pro.v4l2 as v4l2
 
 P2Pro_resolution = (256, 384)
 P2Pro_fps = 25.0
@@ -21,9 +28,24 @@ P2Pro_usb_id = (0x0bda, 0x5830)  # VID, PID
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
+# matches the device lines of `ffmpeg -f avfoundation -list_devices true`, e.g. "[AVFoundation indev @ 0x...] [0] USB Camera"
+_AVF_DEVICE_RE = re.compile(r"\[AVFoundation[^\]]*\] \[(\d+)\] (.+)")
+
+
+def yuv_to_bgr(frame_obj, out: np.ndarray = None) -> np.ndarray:
+    """
+    Converts the YUY2 pseudo color image of a frame to BGR, e.g. for displaying it with OpenCV.
+    Pass the result of the previous call as out to convert into the same buffer instead of allocating a new one.
+    """
+    return cv2.cvtColor(frame_obj["yuv_data"], cv2.COLOR_YUV2BGR_YUY2, dst=out)
+
 
 class FFMpegCapture:
-    def __init__(self, input_source, width, height, framerate=25, convert_rgb=True):
+    def __init__(self, input_source, width, height, num_buffers, framerate=25, convert_rgb=True):
+        # Frames are read into a pool of num_buffers buffers, which are reused round robin. A buffer is only reused once
+        # nothing references its previous frame anymore, otherwise it is replaced by a new one. The pool size just
+        # decides how often that happens.
+        self.num_buffers = num_buffers
         self.width = width
         self.height = height
         self.framerate = framerate
@@ -45,6 +67,28 @@ class FFMpegCapture:
         self.process = subprocess.Popen(self.ffmpeg_command, stdout=subprocess.PIPE, bufsize=10 ** 8)
 
         self.frame_size = self.width * self.height * 2 if not self.convert_rgb else self.width * self.height * 3  # YUY2 format uses 2 bytes per pixel
+        self._alloc_buffers()
+
+    def _new_buffer(self):
+        # YUY2 has 2 bytes per pixel, BGR has 3
+        channels = 3 if self.convert_rgb else 2
+        buf = bytearray(self.frame_size)
+        raw = np.frombuffer(buf, np.uint8)
+        # every view handed out (and every view of those) keeps either raw or buf alive, depending on how numpy
+        # collapses the base chain, so their refcounts tell whether a frame is still in use
+        return buf, raw, memoryview(buf), raw.reshape((self.height, self.width, channels))
+
+    @staticmethod
+    def _refcounts(buf, raw):
+        # has to be called the same way for the idle reference and the check, extra call levels add references
+        return sys.getrefcount(buf), sys.getrefcount(raw)
+
+    def _alloc_buffers(self):
+        self._buffers = [self._new_buffer() for _ in range(self.num_buffers)]
+        self._next_buffer = 0
+        # reference counts of an unused pool buffer, taken the same way read() takes them
+        buf, raw, view, frame = self._buffers[0]
+        self._idle_refcounts = self._refcounts(buf, raw)
 
     def isOpened(self):
         """
@@ -56,18 +100,22 @@ class FFMpegCapture:
         if not self.isOpened():
             return False, None
 
-        raw_frame = self.process.stdout.read(self.frame_size)
-
-        if len(raw_frame) == 0:
-            return False, None
-
-        # Handle the frame based on whether we're using YUY2 or BGR format
-        if not self.convert_rgb:
-            # YUY2 format: reshape as (height, width, 2) since YUY2 has 2 bytes per pixel
-            frame = np.frombuffer(raw_frame, np.uint8).reshape((self.height, self.width, 2))
-        else:
-            # BGR format: reshape as (height, width, 3) since BGR has 3 bytes per pixel
-            frame = np.frombuffer(raw_frame, np.uint8).reshape((self.height, self.width, 3))
+        slot = self._next_buffer
+        self._next_buffer = (self._next_buffer + 1) % len(self._buffers)
+        buf, raw, view, frame = self._buffers[slot]
+        refcounts = self._refcounts(buf, raw)
+        if refcounts[0] > self._idle_refcounts[0] or refcounts[1] > self._idle_refcounts[1]:
+            # a consumer still holds the frame from the last round (e.g. a stalled recorder), leave it alone
+            self._buffers[slot] = self._new_buffer()
+            buf, raw, view, frame = self._buffers[slot]
+
+        # read the frame straight into the preallocated buffer
+        pos = 0
+        while pos < self.frame_size:
+            n = self.process.stdout.readinto(view[pos:])
+            if not n:
+                return False, None
+            pos += n
 
         return True, frame
 
@@ -120,14 +168,34 @@ class FFMpegCapture:
         # Restart FFmpeg with the new settings
         self.process = subprocess.Popen(self.ffmpeg_command, stdout=subprocess.PIPE, bufsize=10 ** 8)
         self.frame_size = self.width * self.height * 2 if not self.convert_rgb else self.width * self.height * 3  # YUY2 format uses 2 bytes per pixel
+        self._alloc_buffers()
 
 
 class Video:
     # queue 0 is for GUI, 1 is for recorder
-    frame_queue = [queue.Queue(1) for _ in range(2)]
-    video_running = False
+    # the GUI only ever wants the latest frame, the recorder gets a few slots to ride out short encoder/disk stalls
+    # without dropping frames
+    frame_queue = [queue.Queue(1), queue.Queue(8)]
     cap = None
-    recording = False
+
+    def __init__(self):
+        self._ready = threading.Event()  # set once the first frame was captured
+        self._stop = threading.Event()
+
+    def frames_in_flight(self) -> int:
+        """
+        Number of captured frames that are typically referenced at the same time: everything the queues can hold, one
+        frame each consumer is working on after taking it from its queue, and the one currently being captured.
+        A stalled consumer can hold on to frames for longer than that.
+        """
+        return sum(q.maxsize for q in self.frame_queue) + len(self.frame_queue) + 1
+
+    def wait_ready(self, timeout=None) -> bool:
+        """
+        Blocks until the first frame was captured. Returns False if the timeout expired before that.
+        """
+        return self._ready.wait(timeout)
+
     @staticmethod
     def list_cap_ids():
         """
@@ -139,7 +207,7 @@ class Video:
         available_ids = []
         log.info("Probing video capture ports...")
         while len(non_working_ids) < 6:  # if there are more than 5 non working ports stop the testing.
-            if platform.system() == "Windows":
+            if IS_WINDOWS:
                 camera = cv2.VideoCapture(dev_port, cv2.CAP_DSHOW)
             else:
                 camera = cv2.VideoCapture(dev_port)
@@ -168,7 +236,7 @@ class Video:
     # Sadly, Windows APIs / OpenCV is very limited, and the only way to detect the camera is by its characteristic resolution and framerate
     # On Linux, just use the VID/PID via udev
     def get_P2Pro_cap_id(self):
-        if platform.system() == 'Linux':
+        if IS_LINUX:
             for device in pyudev.Context().list_devices(subsystem='video4linux'):
                 if (int(device.get('ID_USB_VENDOR_ID'), 16), int(device.get('ID_USB_MODEL_ID'), 16)) == P2Pro_usb_id and \
                         'capture' in device.get('ID_V4L_CAPABILITIES'):
@@ -176,20 +244,17 @@ class Video:
             return None
 
         #on OSX we can only use ffmpeg to list the devices. all other methods don't quite work.
-        if platform.system() == "Darwin":
+        if IS_DARWIN:
             # FFmpeg command to list devices (macOS example, adjust for Windows/Linux)
-            ffmpeg_command = ['ffmpeg', '-f', 'avfoundation', '-list_devices', 'true', '-i', '']
+            ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'info', '-f', 'avfoundation', '-list_devices', 'true', '-i', '']
             # Run the command and capture the output
             result = subprocess.run(ffmpeg_command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
 
             # FFmpeg lists devices to stderr, so we parse stderr
             output = result.stderr.decode('utf-8')
 
-            # Regular expression to capture the device name and index
-            device_regex = re.compile(r"\[(\d+)\] (.*)")
-
             # Find all devices
-            devices = device_regex.findall(output)
+            devices = _AVF_DEVICE_RE.findall(output)
 
             # Look for "USB Camera" in the devices list
             for index, name in devices:
@@ -209,15 +274,18 @@ class Video:
         return None
 
     def open(self, cam_cmd: P2Pro_CMD.P2Pro, camera_id: Union[int, str] = -1):
-        self.recording = True
+        self._stop.clear()
         if camera_id == -1:
             log.info("No camera ID specified, scanning... (This could take a few seconds)")
             camera_id = self.get_P2Pro_cap_id()
             if camera_id == None:
                 raise ConnectionError(f"Could not find camera module")
 
-        if platform.system() == "Darwin":
-            self.cap = FFMpegCapture(camera_id,256,384,convert_rgb=False)
+        if IS_DARWIN:
+            self.cap = FFMpegCapture(camera_id,256,384,self.frames_in_flight(),convert_rgb=False)
+        elif IS_LINUX:
+            # talk to V4L2 directly, the raw YUY2 + 16 bit frames don't need any of OpenCV's processing
+            self.cap = v4l2.V4L2Capture(camera_id, *P2Pro_resolution)
         else:
             # check if video capture can be opened
             self.cap = cv2.VideoCapture(camera_id,cv2)
@@ -229,7 +297,8 @@ class Video:
         # check if resolution and FPS matches that of the P2 Pro module
         cap_res = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
         cap_fps = self.cap.get(cv2.CAP_PROP_FPS)
-        if (cap_res != P2Pro_resolution or cap_fps != P2Pro_fps):
+        # a framerate of 0 means the backend couldn't tell
+        if (cap_res != P2Pro_resolution or (cap_fps and cap_fps != P2Pro_fps)):
             raise IndexError(
                 f"Resolution/FPS of camera id {camera_id} doesn't match. It's probably not a P2 Pro. (Got: {cap_res[0]}x{cap_res[1]}@{cap_fps})")
 
@@ -238,48 +307,59 @@ class Video:
 
         frame_counter = 0
 
-        while self.recording:
-            success, frame = self.cap.read()
-
-            if (not success):
-                continue
-
-            self.video_running = True
-            
-            # On Windows, with RGB conversion turned off, OpenCV returns the image as a 2D array with size [1][<imageLen>]. Turn into 1D array. 
-            if platform.system() == 'Windows':
-                frame = frame[0]
-
-            # split video frame (top is pseudo color, bottom is temperature data)
-            frame_mid_pos = int(len(frame) / 2)
-            picture_data = frame[0:frame_mid_pos]
-            thermal_data = frame[frame_mid_pos:]
-
-            # convert buffers to numpy arrays
-            yuv_picture = np.frombuffer(picture_data, dtype=np.uint8).reshape((P2Pro_resolution[1] // 2, P2Pro_resolution[0], 2))
-            rgb_picture = cv2.cvtColor(yuv_picture, cv2.COLOR_YUV2BGR_YUY2)
-            thermal_picture_16 = np.frombuffer(thermal_data, dtype=np.uint16).reshape((P2Pro_resolution[1] // 2, P2Pro_resolution[0]))
-
-            # pack parsed frame data into object
-            frame_obj = {
-                "frame_num": frame_counter,
-                "rgb_data": rgb_picture,
-                "yuv_data": yuv_picture,
-                "thermal_data": thermal_picture_16
-            }
-
-            # populate all queues with new frame
-            for queue in self.frame_queue:
-                # if queue is full, discard oldest frame (e.g. if frames not read fast enough or at all)
-                if queue.full():
-                    queue.get(False)
-                queue.put(frame_obj)
-
-            frame_counter += 1
+        try:
+            while not self._stop.is_set():
+                success, frame = self.cap.read()
+
+                if (not success):
+                    continue
+
+                self._ready.set()
+
+                # Flatten into a 1D byte array (a view, no copy). On Windows, with RGB conversion turned off, OpenCV returns
+                # the image as a 2D array with size [1][<imageLen>], on the other platforms it is shaped [height][width][2].
+                frame = frame.reshape(-1)
+
+                # split video frame (top is pseudo color, bottom is temperature data)
+                frame_mid_pos = len(frame) // 2
+                picture_data = frame[0:frame_mid_pos]
+                thermal_data = frame[frame_mid_pos:]
+
+                # reinterpret buffers as image arrays, these are views into the captured frame
+                # (YUY2 is kept as is, consumers that need BGR convert it using yuv_to_bgr() when they actually use the frame)
+                yuv_picture = picture_data.reshape((P2Pro_resolution[1] // 2, P2Pro_resolution[0], 2))
+                thermal_picture_16 = thermal_data.view(np.uint16).reshape((P2Pro_resolution[1] // 2, P2Pro_resolution[0]))
+
+                # pack parsed frame data into object
+                frame_obj = {
+                    "frame_num": frame_counter,
+                    "yuv_data": yuv_picture,
+                    "thermal_data": thermal_picture_16
+                }
+
+                # populate all queues with new frame
+                for q in self.frame_queue:
+                    try:
+                        q.put_nowait(frame_obj)
+                    except queue.Full:
+                        # if queue is full, discard oldest frame (e.g. if frames not read fast enough or at all)
+                        try:
+                            q.get_nowait()
+                        except queue.Empty:
+                            pass
+                        try:
+                            q.put_nowait(frame_obj)
+                        except queue.Full:
+                            pass  # someone else refilled the queue in between, skip this frame for it
+
+                frame_counter += 1
+        finally:
+            # released here rather than in stop(), so read() is never interrupted halfway
+            self.cap.release()
 
     def stop(self):
-        self.recording = False
-        self.cap.release()
+        # the capture loop releases the device once it sees this
+        self._stop.set()
 
 if __name__ == "__main__":
     # test stuff
@@ -28,8 +28,7 @@ try:
     video_thread = threading.Thread(target=vid.open, args=(cam_cmd, -1, ))
     video_thread.start()
 
-    while not vid.video_running:
-        time.sleep(0.01)
+    vid.wait_ready()
 
     #rec = P2Pro.recorder.VideoRecorder(vid.frame_queue[1], "test")
     #rec.start()
@@ -49,9 +48,11 @@ try:
     #rec.stop()
     #vid.stop()
 
+    bgr = None
     while True:
         img = vid.frame_queue[0].get(True, 2)
-        cv2.imshow('frame',img["rgb_data"])
+        bgr = P2Pro.video.yuv_to_bgr(img, bgr)
+        cv2.imshow('frame',bgr)
         key = cv2.waitKey(1)
         if key & 0xFF == ord('q'):
             break